@@ -1,18 +1,55 @@
 import serial
 import time
 import threading
+import collections
+import concurrent.futures
 import argparse
+import functools
 import re
 import logging
 import glob
+import os
 import queue
+import select
+import struct
 import psutil
 
+try:
+    import fcntl
+except ImportError:  # Non-POSIX platform; low-latency tuning is skipped
+    fcntl = None
+
+try:
+    import termios
+except ImportError:  # Non-POSIX platform; VMIN/VTIME tuning is skipped
+    termios = None
+
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # Número de teléfono global para respuestas
 RESPONSE_PHONE_NUMBER = "3147654655"
 
+# ioctl request codes y layout del serial_struct del kernel (ver pyserial PR #290)
+TIOCGSERIAL = 0x541E
+TIOCSSERIAL = 0x541F
+ASYNC_LOW_LATENCY = 0x2000
+SERIAL_STRUCT_FORMAT = "iiIIhchhiIIiIIIIIIII"
+
+# Códigos que cierran un intercambio AT
+_TERMINAL_CODES = frozenset(('OK', 'ERROR', '>'))
+
+@functools.lru_cache(maxsize=128)
+def _encode_at(cmd):
+    # Los comandos de inicialización y de SMS se repiten verbatim;
+    # codificarlos una sola vez evita el concat + encode por llamada
+    return (cmd + '\r\n').encode()
+
+
+# Patrones compilados una sola vez para el hot path de cada SMS
+_CMTI_RE = re.compile(r'\+CMTI:\s*"[^"]+",\s*(\d+)')
+_CMGR_RE = re.compile(r'\+CMGR:\s*"([^"]+)",\s*"([^"]+)",(.*?),\s*"([^"]+)"')
+
 class ModemHandler:
     def __init__(self, port=None, baudrate=115200, timeout=1):
         self.port = port
@@ -20,12 +57,18 @@ class ModemHandler:
         self.timeout = timeout
         self.ser = None
         self.running = False
-        self.lock = threading.Lock()
-        self.response_queue = queue.Queue()
+        # _tx_lock sólo cubre la escritura; _cmd_done serializa los comandos
+        # completos sin retener un mutex durante la espera de la respuesta
+        self._tx_lock = threading.Lock()
+        self._cmd_done = threading.Event()
+        self._cmd_done.set()
+        self.response_queue = queue.SimpleQueue()
         self.event_queue = queue.Queue()
         self.outgoing_sms_queue = queue.Queue()
         self.current_command = None
-        self.processed_messages = {}  # Cambiado a un diccionario
+        # Orden de inserción == orden de antigüedad: la expiración sólo mira
+        # el frente y el tamaño queda acotado aunque nunca se limpie
+        self.processed_messages = collections.OrderedDict()
 
     def connect(self):
         if not self.port:
@@ -34,14 +77,17 @@ class ModemHandler:
 
         try:
             self.ser = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
-            logging.info(f"Connected to {self.port} at {self.baudrate} baud")
+            self.enable_low_latency()
+            self.configure_blocking_reads()
+            logger.info("Connected to %s at %s baud", self.port, self.baudrate)
             self.running = True
-            self.read_thread = threading.Thread(target=self.read_serial)
+            # Daemon: el lector no mantiene vivo al proceso si main sale
+            self.read_thread = threading.Thread(target=self.read_serial, daemon=True)
             self.read_thread.start()
             self.initialize_modem()
             return True
         except Exception as e:
-            logging.error(f"Failed to connect: {e}")
+            logger.error("Failed to connect: %s", e)
             return False
 
     def initialize_modem(self):
@@ -54,108 +100,234 @@ class ModemHandler:
         ]
         for cmd in initialization_commands:
             response = self.send_command(cmd)
-            logging.info(f"Initialization command {cmd} response: {response}")
+            logger.info("Initialization command %s response: %s", cmd, response)
+
+    def enable_low_latency(self):
+        # Baja el latency_timer del bridge USB-UART de 16 ms a 1 ms
+        if not self.ser or not self.ser.is_open or fcntl is None:
+            return False
+        try:
+            fd = self.ser.fileno()
+            raw = fcntl.ioctl(fd, TIOCGSERIAL,
+                              struct.pack(SERIAL_STRUCT_FORMAT, 0, 0, 0, 0, 0, b'\0', *([0] * 14)))
+            fields = list(struct.unpack(SERIAL_STRUCT_FORMAT, raw))
+            fields[4] |= ASYNC_LOW_LATENCY
+            fcntl.ioctl(fd, TIOCSSERIAL, struct.pack(SERIAL_STRUCT_FORMAT, *fields))
+            return True
+        except (OSError, struct.error) as e:
+            logger.debug("Low-latency ioctl failed on %s: %s", self.port, e)
+        # Fallback cuando el ioctl falla por permisos
+        try:
+            tty_name = os.path.basename(self.port or '')
+            with open(f'/sys/bus/usb-serial/devices/{tty_name}/latency_timer', 'w') as f:
+                f.write('1')
+            return True
+        except OSError as e:
+            logger.debug("Could not reduce latency_timer for %s: %s", self.port, e)
+        return False
+
+    def configure_blocking_reads(self):
+        # VMIN=1/VTIME=0: el kernel entrega en cuanto llega un byte
+        if not self.ser or not self.ser.is_open or termios is None:
+            return
+        try:
+            fd = self.ser.fileno()
+            attrs = termios.tcgetattr(fd)
+            attrs[6][termios.VMIN] = 1
+            attrs[6][termios.VTIME] = 0
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        except (termios.error, OSError) as e:
+            logger.debug("Could not tune VMIN/VTIME on %s: %s", self.port, e)
+
+    def _probe_port(self, port, budget=0.3):
+        # Sonda directa no bloqueante (el hilo lector aún no existe), con un
+        # presupuesto de 300 ms en vez del timeout completo
+        ser = None
+        try:
+            ser = serial.Serial(port, self.baudrate, timeout=0)
+            fd = ser.fileno()
+            ser.write(b'AT\r\n')
+            deadline = time.monotonic() + budget
+            response = b''
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                ready, _, _ = select.select([fd], [], [], remaining)
+                if not ready:
+                    break
+                response += os.read(fd, 256)
+                if b'OK' in response:
+                    return port
+            return None
+        except (serial.SerialException, OSError, ValueError) as e:
+            logger.debug("Failed to probe %s: %s", port, e)
+            return None
+        finally:
+            if ser is not None:
+                try:
+                    ser.close()
+                except Exception:
+                    pass
 
     def find_working_port(self):
+        # Sondear todos los candidatos en paralelo: el tiempo total es el del
+        # puerto más lento, no la suma de todos
         tty_ports = glob.glob('/dev/ttyUSB*')
-        for port in tty_ports:
-            try:
-                self.port = port
-                self.ser = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
-                response = self.send_command('AT')
-                if 'OK' in response:
-                    logging.info(f"Found working port: {port}")
+        if not tty_ports:
+            logger.error("No working port found")
+            return False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(tty_ports)) as executor:
+            futures = {executor.submit(self._probe_port, port): port for port in tty_ports}
+            for future in concurrent.futures.as_completed(futures):
+                port = future.result()
+                if port:
+                    self.port = port
+                    logger.info("Found working port: %s", port)
+                    executor.shutdown(wait=False, cancel_futures=True)
                     return True
-                self.ser.close()
-            except Exception as e:
-                logging.debug(f"Failed to connect to {port}: {e}")
-        logging.error("No working port found")
+        logger.error("No working port found")
         return False
 
     def send_command(self, command, wait_time=2):
-        with self.lock:
-            if not self.ser or not self.ser.is_open:
-                logging.warning("Modem is not connected. Attempting to reconnect...")
-                if not self.connect():
-                    return "Error: Modem not connected"
-            
+        # Reconectar ANTES de tomar el turno: connect() -> initialize_modem()
+        # vuelve a entrar aquí y se bloquearía esperando el turno que nosotros
+        # mismos retenemos
+        if not self.ser or not self.ser.is_open:
+            logger.warning("Modem is not connected. Attempting to reconnect...")
+            if not self.connect():
+                return "Error: Modem not connected"
+
+        # Esperar el turno: un solo comando AT en vuelo a la vez
+        while True:
+            self._cmd_done.wait()
+            with self._tx_lock:
+                if self._cmd_done.is_set():
+                    self._cmd_done.clear()
+                    break
+        try:
             try:
-                self.current_command = command
-                logging.debug(f"Sending command: {command}")
-                self.ser.write((command + '\r\n').encode())
-                
+                with self._tx_lock:
+                    self.current_command = command
+                    # Descartar restos de un comando anterior que haya
+                    # expirado antes de llegar su respuesta completa
+                    while True:
+                        try:
+                            self.response_queue.get_nowait()
+                        except queue.Empty:
+                            break
+                    logger.debug("Sending command: %s", command)
+                    self.ser.write(_encode_at(command))
+
                 response = self.wait_for_response(wait_time)
-                
-                logging.debug(f"Raw command response:\n{response}")
+
+                logger.debug("Raw command response:\n%s", response)
                 return response
             except Exception as e:
-                logging.error(f"Error sending command: {e}")
+                logger.error("Error sending command: %s", e)
                 return f"Error: {str(e)}"
             finally:
                 self.current_command = None
+        finally:
+            self._cmd_done.set()
 
     def wait_for_response(self, timeout):
-        start_time = time.time()
+        # Todas las lecturas del puerto pasan por read_serial -> response_queue;
+        # aquí sólo se consume la cola hasta el código final o el deadline
+        deadline = time.monotonic() + timeout
         response = []
-        while time.time() - start_time < timeout:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
             try:
-                line = self.ser.readline().decode(errors='ignore').strip()
-                if line:
-                    response.append(line)
-                    if line in ['OK', 'ERROR', '>', '+CMS ERROR:'] or '+CMGS:' in line:
-                        break
-            except serial.SerialException as e:
-                logging.error(f"Error reading from serial port: {e}")
+                line = self.response_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            response.append(line)
+            # frozenset: una búsqueda por hash en vez de recorrer una lista
+            # recreada por línea; el error CMS llega con código ("+CMS ERROR:
+            # 321"), así que se compara por prefijo
+            if (line in _TERMINAL_CODES or line.startswith('+CMS ERROR:')
+                    or '+CMGS:' in line):
                 break
         return '\n'.join(response)
 
     def read_serial(self):
-        buffer = ""
+        # bytearray: append O(1) amortizado y una sola decodificación ASCII
+        # por línea completa, en vez de decodificar cada chunk parcial
+        buffer = bytearray()
+        fd = self.ser.fileno()
         while self.running:
             try:
-                if self.ser.in_waiting:
-                    data = self.ser.read(self.ser.in_waiting).decode(errors='ignore')
-                    buffer += data
-                    lines = buffer.split('\n')
-                    buffer = lines.pop()
-                    for line in lines:
-                        line = line.strip()
-                        if line:
-                            logging.debug(f"Raw serial data: {line}")
-                            if self.current_command and (line == self.current_command or line in ['OK', 'ERROR', '>'] or line.startswith('+')):
-                                self.response_queue.put(line)
-                            elif '+CMTI:' in line:
-                                logging.info(f"SMS notification received: {line}")
-                                self.event_queue.put(line)
-                            else:
-                                self.event_queue.put(line)
-            except serial.SerialException as e:
-                logging.error(f"Serial error in read_serial: {e}")
+                ready, _, _ = select.select([fd], [], [], 0.5)
+                if ready:
+                    # read corto directo: un syscall por despertar, sin el
+                    # ioctl FIONREAD que pagaba in_waiting
+                    buffer += os.read(fd, 4096)
+                    while True:
+                        idx = buffer.find(b'\n')
+                        if idx < 0:
+                            break
+                        line = bytes(buffer[:idx]).decode('ascii', 'replace').strip()
+                        del buffer[:idx + 1]
+                        if not line:
+                            continue
+                        # Llamada por línea: saltar el logger entero si DEBUG
+                        # está apagado, no sólo el formateo
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("Raw serial data: %s", line)
+                        # Con un comando en vuelo, todo lo que no sea un URC
+                        # real es parte de su respuesta: el cuerpo de un CMGR
+                        # no puede clasificarse por forma
+                        if '+CMTI:' in line:
+                            logger.info("SMS notification received: %s", line)
+                            self.event_queue.put(line)
+                        elif line == 'RING':
+                            self.event_queue.put(line)
+                        elif self.current_command:
+                            self.response_queue.put(line)
+                        else:
+                            self.event_queue.put(line)
+                    # El prompt de AT+CMGS ('> ') llega sin newline
+                    if self.current_command and buffer.strip() == b'>':
+                        self.response_queue.put('>')
+                        del buffer[:]
+            except (serial.SerialException, OSError) as e:
+                # Única vía de recuperación: cerrar el puerto para que el
+                # próximo send_command reconecte; otras excepciones son bugs
+                # y deben propagarse, no dormirse en un bucle
+                logger.error("Serial error in read_serial: %s", e)
+                self.running = False
+                if self.ser is not None:
+                    try:
+                        self.ser.close()
+                    except OSError:
+                        pass
                 break
-            except Exception as e:
-                logging.error(f"Unexpected error in read_serial: {e}")
-            time.sleep(0.1)
 
     def handle_incoming_sms(self, notification):
-        match = re.search(r'\+CMTI:\s*"[^"]+",\s*(\d+)', notification)
+        match = _CMTI_RE.search(notification)
         if match:
             index = match.group(1)
             content = self.send_command(f'AT+CMGR={index}')
-            logging.info(f"Raw SMS content:\n{content}")
+            logger.info("Raw SMS content:\n%s", content)
             parsed_content = self.parse_sms_content(content)
-            logging.info(f"Parsed SMS content:\n{parsed_content}")
+            logger.info("Parsed SMS content:\n%s", parsed_content)
             
             if parsed_content and 'message' in parsed_content:
                 message_id = (parsed_content['sender'], parsed_content['timestamp'], parsed_content['message'])
                 if message_id in self.processed_messages:
-                    logging.info(f"Duplicate message detected. Skipping processing.")
+                    logger.info("Duplicate message detected. Skipping processing.")
                 else:
-                    self.processed_messages[message_id] = time.time()
+                    if len(self.processed_messages) >= 10000:
+                        self.processed_messages.popitem(last=False)
+                    self.processed_messages[message_id] = time.monotonic()
                     self.process_sms_command(parsed_content)
             
             # Delete the message after reading
             delete_response = self.send_command(f'AT+CMGD={index}')
-            logging.info(f"Delete SMS response: {delete_response}")
+            logger.info("Delete SMS response: %s", delete_response)
 
             # Limpiar mensajes procesados antiguos
             self.clean_processed_messages()
@@ -163,25 +335,31 @@ class ModemHandler:
     def parse_sms_content(self, content):
         lines = content.split('\n')
         if len(lines) < 2:
-            logging.error(f"Unexpected SMS format: {content}")
+            logger.error("Unexpected SMS format: %s", content)
             return None
-        
-        header = next((line for line in lines if line.startswith('+CMGR:')), '')
-        
-        if not header:
-            logging.error(f"CMGR header not found in content: {content}")
+
+        # Localizar el header recordando su índice: una sola pasada, sin el
+        # lines.index() que volvía a recorrer la lista
+        header_index = -1
+        for i, line in enumerate(lines):
+            if line.startswith('+CMGR:'):
+                header_index = i
+                break
+
+        if header_index < 0:
+            logger.error("CMGR header not found in content: %s", content)
             return None
-        
+
         # Parse header
-        header_match = re.search(r'\+CMGR:\s*"([^"]+)",\s*"([^"]+)",(.*?),\s*"([^"]+)"', header)
+        header_match = _CMGR_RE.search(lines[header_index])
         if header_match:
             status, sender, _, timestamp = header_match.groups()
         else:
-            logging.error(f"Failed to parse header: {header}")
+            logger.error("Failed to parse header: %s", lines[header_index])
             status, sender, timestamp = "Unknown", "Unknown", "Unknown"
-        
+
         # The message content is in the lines after the header
-        message = '\n'.join(line.strip() for line in lines[lines.index(header)+1:] if line.strip() and line.strip() != 'OK')
+        message = '\n'.join(line.strip() for line in lines[header_index + 1:] if line.strip() and line.strip() != 'OK')
         
         return {
             "status": status,
@@ -193,7 +371,7 @@ class ModemHandler:
 
     def process_sms_command(self, sms_data):
         command = sms_data['message'].strip().lower()
-        logging.info(f"Processing command: {command}")
+        logger.info("Processing command: %s", command)
         if command == 'cpu':
             cpu_usage = self.get_cpu_usage()
             response = f"CPU Usage: {cpu_usage}%"
@@ -202,7 +380,7 @@ class ModemHandler:
             response = f"Available RAM: {ram_info}"
         else:
             response = f"Unknown command: {command}"
-            logging.info(f"Unknown command received: {command}")
+            logger.info("Unknown command received: %s", command)
 
         # Encolar el SMS de respuesta
         self.outgoing_sms_queue.put((RESPONSE_PHONE_NUMBER, response))
@@ -222,16 +400,19 @@ class ModemHandler:
             except queue.Empty:
                 continue
             except Exception as e:
-                logging.error(f"Error handling outgoing SMS: {e}")
+                logger.error("Error handling outgoing SMS: %s", e)
 
     def clean_processed_messages(self):
-        current_time = time.time()
-        old_messages = [msg_id for msg_id, timestamp in self.processed_messages.items() if current_time - timestamp > 3600]  # 1 hora
-        for msg_id in old_messages:
-            del self.processed_messages[msg_id]
+        # Los más antiguos están al frente: expirar es O(expirados), no O(n)
+        current_time = time.monotonic()
+        while self.processed_messages:
+            _, timestamp = next(iter(self.processed_messages.items()))
+            if current_time - timestamp <= 3600:  # 1 hora
+                break
+            self.processed_messages.popitem(last=False)
 
     def send_sms(self, phone_number, message):
-        logging.info(f"Sending SMS to {phone_number}: {message}")
+        logger.info("Sending SMS to %s: %s", phone_number, message)
         # Configurar modo texto y codificación
         self.send_command('AT+CMGF=1')
         self.send_command('AT+CSCS="GSM"')
@@ -245,34 +426,34 @@ class ModemHandler:
             response = self.send_command(full_message, wait_time=10)
             
             if "+CMGS:" in response:
-                logging.info(f"SMS enviado exitosamente a {phone_number}")
+                logger.info("SMS enviado exitosamente a %s", phone_number)
                 return True
             else:
-                logging.error(f"Error al enviar SMS. Respuesta: {response}")
+                logger.error("Error al enviar SMS. Respuesta: %s", response)
                 return False
         else:
-            logging.error(f"No se recibió el prompt para enviar el SMS. Respuesta: {response}")
+            logger.error("No se recibió el prompt para enviar el SMS. Respuesta: %s", response)
             return False
 
     def listen_for_events(self):
         while self.running:
             try:
                 event = self.event_queue.get(timeout=0.5)
-                logging.debug(f"Event received: {event}")
+                logger.debug("Event received: %s", event)
                 if '+CMTI:' in event:
-                    logging.info("New SMS notification received!")
+                    logger.info("New SMS notification received!")
                     self.handle_incoming_sms(event)
                 elif event == 'RING':
-                    logging.info("Incoming call!")
+                    logger.info("Incoming call!")
                     self.handle_incoming_call()
                 elif event in ['OK', 'ERROR']:
-                    logging.debug(f"Modem response: {event}")
+                    logger.debug("Modem response: %s", event)
                 else:
-                    logging.debug(f"Unhandled event: {event}")
+                    logger.debug("Unhandled event: %s", event)
             except queue.Empty:
                 pass
             except Exception as e:
-                logging.error(f"Error in event listener: {e}")
+                logger.error("Error in event listener: %s", e)
 
     def handle_incoming_call(self):
         # Implementar lógica para manejar llamadas entrantes si es necesario
@@ -283,7 +464,9 @@ class ModemHandler:
         if self.ser and self.ser.is_open:
             self.ser.close()
         if hasattr(self, 'read_thread'):
-            self.read_thread.join()
+            self.read_thread.join(timeout=2)
+            if self.read_thread.is_alive():
+                logger.warning("Read thread did not stop within 2s; detaching")
 
 def main():
     parser = argparse.ArgumentParser(description="Modem handler for SMS, calls, and AT commands")
@@ -302,7 +485,7 @@ def main():
     modem = ModemHandler(port=args.port, baudrate=args.baudrate)
 
     if not modem.connect():
-        logging.error("Failed to connect to the modem. Please check the connection and try again.")
+        logger.error("Failed to connect to the modem. Please check the connection and try again.")
         return
 
     listen_thread = threading.Thread(target=modem.listen_for_events)
@@ -311,8 +494,8 @@ def main():
     outgoing_sms_thread = threading.Thread(target=modem.handle_outgoing_sms)
     outgoing_sms_thread.start()
 
-    logging.info("Modem handler ready. Type 'send_sms' to send a message, 'at' to enter AT command mode, or 'quit' to exit.")
-    logging.info(f"The modem is now listening for incoming SMS messages. System info responses will be sent to {RESPONSE_PHONE_NUMBER}")
+    logger.info("Modem handler ready. Type 'send_sms' to send a message, 'at' to enter AT command mode, or 'quit' to exit.")
+    logger.info("The modem is now listening for incoming SMS messages. System info responses will be sent to %s", RESPONSE_PHONE_NUMBER)
 
     try:
         while True:
@@ -323,18 +506,18 @@ def main():
                 phone_number = input("Enter the phone number: ")
                 message = input("Enter the message: ")
                 modem.outgoing_sms_queue.put((phone_number, message))
-                logging.info("SMS queued for sending")
+                logger.info("SMS queued for sending")
             elif command.lower() == 'at':
                 while True:
                     at_command = input("Enter AT command (or 'back' to return): ")
                     if at_command.lower() == 'back':
                         break
                     response = modem.send_command(at_command)
-                    logging.info(f"Response:\n{response}")
+                    logger.info("Response:\n%s", response)
             else:
-                logging.warning("Unknown command. Use 'send_sms', 'at', or 'quit'.")
+                logger.warning("Unknown command. Use 'send_sms', 'at', or 'quit'.")
     except KeyboardInterrupt:
-        logging.info("\nInterruption detected. Closing...")
+        logger.info("\nInterruption detected. Closing...")
     finally:
         modem.stop()
         listen_thread.join()
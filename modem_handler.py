@@ -2,14 +2,30 @@ import serial
 import time
 import threading
 import argparse
+import collections
+import concurrent.futures
 import re
 import logging
 import glob
+import hashlib
+import os
 import queue
+import select
+import struct
 import psutil
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import subprocess
 
+try:
+    import fcntl
+except ImportError:  # Non-POSIX platform; low-latency tuning is skipped
+    fcntl = None
+
+try:
+    import termios
+except ImportError:  # Non-POSIX platform; VMIN/VTIME tuning is skipped
+    termios = None
+
 # Configuración del logging con rotación de archivos
 log_filename = 'modem_handler.log'
 max_log_size = 10 * 1024 * 1024  # Tamaño máximo de cada archivo de log: 10 MB
@@ -21,31 +37,132 @@ handler.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 
-# Configurar el logger principal
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-logger.addHandler(handler)
-
-# También se agrega el StreamHandler para ver los logs en consola
+# StreamHandler para ver los logs en consola
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+
+# Los hilos calientes (lector/escritor) sólo encolan el registro; un
+# QueueListener en su propio hilo paga el write al archivo y a consola
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, handler, console_handler,
+                              respect_handler_level=True)
+_log_listener.start()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(QueueHandler(_log_queue))
+
+# ioctl request codes y layout del serial_struct del kernel (ver pyserial PR #290)
+TIOCGSERIAL = 0x541E
+TIOCSSERIAL = 0x541F
+ASYNC_LOW_LATENCY = 0x2000
+SERIAL_STRUCT_FORMAT = "iiIIhchhiIIiIIIIIIII"
+
+# Códigos que cierran un intercambio AT; frozenset: una búsqueda por hash
+# en vez de recorrer una lista recreada por línea
+_TERMINAL_CODES = frozenset(('OK', 'ERROR', '>'))
+
+# Patrones compilados una sola vez; se usan en el hot path de cada SMS
+_CMTI_RE = re.compile(r'\+CMTI:\s*"[^"]+",\s*(\d+)')
+_CSQ_RE = re.compile(r'\+CSQ:\s*(\d+),')
+
+
+def _csq_label(rssi):
+    """Etiqueta de calidad para un valor RSSI de AT+CSQ (escala 3GPP)."""
+    if rssi >= 20:
+        return f"Excellent (-{73 - (rssi - 20) * 2} dBm)"
+    elif rssi >= 15:
+        return f"Good (-{93 - (rssi - 15) * 2} dBm)"
+    elif rssi >= 10:
+        return f"Fair (-{103 - (rssi - 10) * 2} dBm)"
+    else:
+        return f"Poor (-{113 - rssi * 2} dBm)"
+
+
+# Tabla precalculada en import: la consulta es un lookup, sin aritmética ni
+# formateo de strings por llamada. 99 es el centinela "sin señal" del estándar.
+_CSQ_TABLE = {i: _csq_label(i) for i in range(32)}
+_CSQ_TABLE[99] = "No signal"
 
 
 class ModemHandler:
-    def __init__(self, port=None, baudrate=115200, timeout=1):
+    # Sin __dict__ por instancia: menos memoria y acceso a atributos por
+    # índice fijo, útil cuando conviven varios handlers (multi-módem)
+    __slots__ = (
+        'port', 'baudrate', 'timeout', 'max_response_bytes', 'trusted_senders',
+        'ser', 'running',
+        '_cmd_queue', '_writer_thread', '_connect_lock',
+        'response_lines', 'response_event',
+        'event_queue', '_dropped_events', 'outgoing_sms_queue',
+        '_response_accum', '_sysinfo_cache',
+        'current_command', '_poll', 'processed_digests', '_text_mode_set',
+        '_urc_handlers', '_sms_commands', 'read_thread',
+    )
+
+    # Cache de comandos ya codificados: los de inicialización y los de cada
+    # SMS se reenvían verbatim, así que se codifican una sola vez
+    _CMD_CACHE = {}
+
+    def __init__(self, port=None, baudrate=115200, timeout=1, max_response_bytes=8192,
+                 trusted_senders=()):
         self.port = port
         self.baudrate = baudrate
         self.timeout = timeout
+        self.max_response_bytes = max_response_bytes
+        # Remitentes de confianza: sus comandos cortos de control saltan la
+        # deduplicación (son fire-and-forget, repetirlos es inocuo)
+        self.trusted_senders = frozenset(trusted_senders)
         self.ser = None
         self.running = False
-        self.lock = threading.Lock()
-        self.response_queue = queue.Queue()
-        self.event_queue = queue.Queue()
+        # Un único hilo escritor posee el puerto: los llamantes encolan
+        # (payload, Future) y esperan su resultado, así los comandos quedan
+        # serializados en el cable sin ninguna sección crítica
+        self._cmd_queue = queue.Queue()
+        self._writer_thread = None
+        # Sólo protege el chequeo-y-reconexión: dos hilos que ven el puerto
+        # caído no deben abrir el dispositivo dos veces ni duplicar el lector
+        self._connect_lock = threading.Lock()
+        # SPSC ring between read_serial (producer) and wait_for_response
+        # (consumer): deque append/popleft son atómicos bajo el GIL, el Event
+        # sólo provee el wakeup.
+        self.response_lines = collections.deque(maxlen=256)
+        self.response_event = threading.Event()
+        # Cola acotada: bajo una tormenta de URCs es preferible descartar
+        # eventos (contados) a crecer sin límite o bloquear al hilo lector
+        self.event_queue = queue.Queue(maxsize=64)
+        self._dropped_events = 0
         self.outgoing_sms_queue = queue.Queue()
         self.current_command = None
-        self.processed_messages = {}
+        # Acumulador reutilizado por el hilo escritor (único llamante de los
+        # wait_*): evita asignar una lista nueva por comando
+        self._response_accum = []
+        self._poll = None
+        self.read_thread = None
+        # Insertion order == age order, so expiry only ever looks at the front
+        self.processed_digests = collections.OrderedDict()
+        self._text_mode_set = False
+        # Tabla de despacho de URCs: un lookup por prefijo en vez de una
+        # cadena de comparaciones por cada evento
+        self._urc_handlers = {
+            '+CMTI': self.handle_incoming_sms,
+            'RING': self.handle_incoming_call,
+        }
+        # Comandos aceptados por SMS: mismo patrón de despacho que los URCs
+        self._sms_commands = {
+            'cpu': lambda: f"CPU Usage: {self.get_cpu_usage()}%",
+            'ram': lambda: f"Available RAM: {self.get_ram_info()}",
+            'signal': lambda: f"Signal Strength: {self.get_signal_strength()}",
+            'discover': self.execute_mactelnet,
+        }
+        # Cache con TTL de 1 s para las métricas de sistema: una ráfaga de
+        # SMS "cpu"/"ram" no dispara un syscall de psutil por mensaje
+        self._sysinfo_cache = {}
+        # Prime psutil's internal CPU counter so later non-blocking reads
+        # return the usage since this point instead of a meaningless 0.0
+        psutil.cpu_percent(interval=None)
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
 
     def connect(self):
         """Connect to the modem and initialize it. Tries to find a working port if not specified."""
@@ -55,9 +172,20 @@ class ModemHandler:
 
         try:
             self.ser = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
+            self.enable_low_latency()
+            self.configure_blocking_reads()
+            # epoll recuerda el fd registrado entre llamadas y evita el ioctl
+            # TIOCINQ por iteración del viejo esquema de in_waiting
+            if hasattr(select, 'epoll'):
+                if self._poll is not None:
+                    self._poll.close()
+                self._poll = select.epoll()
+                self._poll.register(self.ser.fileno(), select.EPOLLIN)
             logger.info(f"Connected to {self.port} at {self.baudrate} baud")
             self.running = True
-            self.read_thread = threading.Thread(target=self.read_serial)
+            # Daemon: si el proceso sale por una excepción, el lector no
+            # mantiene vivo al intérprete esperando datos del puerto
+            self.read_thread = threading.Thread(target=self.read_serial, daemon=True)
             self.read_thread.start()
             self.initialize_modem()
             return True
@@ -70,107 +198,300 @@ class ModemHandler:
 
     def initialize_modem(self):
         """Send initialization commands to the modem."""
-        initialization_commands = [
-            'AT',  # Basic AT command
-            'AT+CMGF=1',  # Set SMS text mode
-            'AT+CSCS="GSM"',  # Set character set
-            'AT+CNMI=2,1,0,0,0',  # Configure new message indications
-            'AT+CLIP=1',  # Enable Calling Line Identification Presentation
-        ]
-        for cmd in initialization_commands:
-            response = self.send_command(cmd)
-            logger.info(f"Initialization command {cmd} response: {response}")
+        # Sonda básica primero; después toda la configuración encadenada con
+        # ';' (V.250): un solo round-trip en vez de uno por comando.
+        # CMGF=1 texto, CSCS charset, CNMI indicaciones de SMS, CLIP caller ID.
+        response = self.send_command('AT')
+        logger.info(f"Initialization probe AT response: {response}")
+        response = self.send_command('AT+CMGF=1;+CSCS="GSM";+CNMI=2,1,0,0,0;+CLIP=1', wait_time=3)
+        logger.info(f"Initialization command chain response: {response}")
+        if 'OK' not in response:
+            # Algunos firmwares rechazan la concatenación con ';': reenviar
+            # cada comando por separado como respaldo
+            logger.warning("Chained initialization rejected; retrying commands individually")
+            for cmd in ('AT+CMGF=1', 'AT+CSCS="GSM"', 'AT+CNMI=2,1,0,0,0', 'AT+CLIP=1'):
+                response = self.send_command(cmd)
+                logger.info(f"Initialization command {cmd} response: {response}")
+        self._text_mode_set = True
+
+    def enable_low_latency(self):
+        """Enable ASYNC_LOW_LATENCY on the serial fd so the USB-UART bridge
+        delivers data after 1 ms instead of its default 16 ms latency timer."""
+        if not self.ser or not self.ser.is_open or fcntl is None:
+            return False
+        try:
+            fd = self.ser.fileno()
+            raw = fcntl.ioctl(fd, TIOCGSERIAL,
+                              struct.pack(SERIAL_STRUCT_FORMAT, 0, 0, 0, 0, 0, b'\0', *([0] * 14)))
+            fields = list(struct.unpack(SERIAL_STRUCT_FORMAT, raw))
+            fields[4] |= ASYNC_LOW_LATENCY
+            fcntl.ioctl(fd, TIOCSSERIAL, struct.pack(SERIAL_STRUCT_FORMAT, *fields))
+            logger.debug("ASYNC_LOW_LATENCY enabled on %s", self.port)
+            return True
+        except (OSError, struct.error) as e:
+            logger.debug("Low-latency ioctl failed on %s: %s", self.port, e)
+        # Fallback cuando el ioctl falla por permisos: el knob de sysfs hace lo mismo
+        try:
+            tty_name = os.path.basename(self.port or '')
+            with open(f'/sys/bus/usb-serial/devices/{tty_name}/latency_timer', 'w') as f:
+                f.write('1')
+            logger.debug("latency_timer set to 1 ms for %s", tty_name)
+            return True
+        except OSError as e:
+            logger.debug("Could not reduce latency_timer for %s: %s", self.port, e)
+        return False
+
+    def configure_blocking_reads(self):
+        """Set termios VMIN=1/VTIME=0 so the kernel wakes the read thread the
+        instant a byte arrives instead of us polling in_waiting."""
+        if not self.ser or not self.ser.is_open or termios is None:
+            return
+        try:
+            fd = self.ser.fileno()
+            attrs = termios.tcgetattr(fd)
+            attrs[6][termios.VMIN] = 1
+            attrs[6][termios.VTIME] = 0
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        except (termios.error, OSError) as e:
+            logger.debug("Could not tune VMIN/VTIME on %s: %s", self.port, e)
+
+    def _probe_port(self, port, budget=0.3):
+        """Probe one candidate port with a brief AT/OK exchange. Runs before the
+        read thread exists, so it reads the port directly."""
+        ser = None
+        try:
+            ser = serial.Serial(port, self.baudrate, timeout=0)
+            fd = ser.fileno()
+            ser.write(b'AT\r\n')
+            deadline = time.monotonic() + budget
+            response = b''
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                ready, _, _ = select.select([fd], [], [], remaining)
+                if not ready:
+                    break
+                response += os.read(fd, 256)
+                if b'OK' in response:
+                    return port
+            return None
+        except (serial.SerialException, OSError, ValueError) as e:
+            logger.debug("Failed to probe %s: %s", port, e)
+            return None
+        finally:
+            if ser is not None:
+                try:
+                    ser.close()
+                except Exception:
+                    pass
 
     def find_working_port(self):
-        """Find a working serial port among available ttyUSB ports."""
+        """Find a working serial port by probing all ttyUSB candidates in parallel."""
         tty_ports = glob.glob('/dev/ttyUSB*')
-        for port in tty_ports:
-            try:
-                self.port = port
-                self.ser = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
-                response = self.send_command('AT')
-                if 'OK' in response:
+        if not tty_ports:
+            logger.error("No working port found")
+            return False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(tty_ports)) as executor:
+            futures = {executor.submit(self._probe_port, port): port for port in tty_ports}
+            for future in concurrent.futures.as_completed(futures):
+                port = future.result()
+                if port:
+                    self.port = port
                     logger.info(f"Found working port: {port}")
+                    executor.shutdown(wait=False, cancel_futures=True)
                     return True
-                self.ser.close()
-            except Exception as e:
-                logger.debug(f"Failed to connect to {port}: {e}")
         logger.error("No working port found")
         return False
 
     def send_command(self, command, wait_time=2):
-        """Send a command to the modem and wait for a response."""
-        with self.lock:
-            if not self.ser or not self.ser.is_open:
-                logger.warning("Modem is not connected. Attempting to reconnect...")
-                if not self.connect():
-                    return "Error: Modem not connected"
-            
+        """Send a command to the modem and wait for a response.
+
+        `command` may be a str or pre-encoded bytes (without the CR/LF
+        trailer); bytes skip the encode step entirely.
+
+        The write itself happens on the single writer thread; this call only
+        encodes the payload, submits it and parks on its Future, so callers
+        never hold a lock while waiting and commands stay serialized on the
+        wire by construction."""
+        if not self.ser or not self.ser.is_open:
+            with self._connect_lock:
+                # Re-chequear bajo el lock: otro hilo pudo reconectar ya
+                if not self.ser or not self.ser.is_open:
+                    logger.warning("Modem is not connected. Attempting to reconnect...")
+                    if not self.connect():
+                        return "Error: Modem not connected"
+
+        if isinstance(command, bytes):
+            payload = command + b'\r\n'
+            label = command.decode('ascii', 'replace')
+        else:
+            label = command
+            payload = self._CMD_CACHE.get(command)
+            if payload is None:
+                payload = (command + '\r\n').encode('utf-8', 'replace')
+                # Sólo se cachean comandos AT; los cuerpos de SMS
+                # son arbitrarios y crecerían el cache sin límite
+                if command.startswith('AT') and len(self._CMD_CACHE) < 128:
+                    self._CMD_CACHE[command] = payload
+        return self._submit(payload, label, wait_time)
+
+    def _submit(self, payload, label, wait_time, is_sms_body=False):
+        """Queue a payload for the writer thread and wait for its response."""
+        fut = concurrent.futures.Future()
+        self._cmd_queue.put((payload, label, wait_time, is_sms_body, fut))
+        return fut.result()
+
+    def _writer_loop(self):
+        """Single owner of the transmit side of the port.
+
+        Drains the submission queue one entry at a time: write the payload,
+        collect the response, resolve the caller's Future. Being the only
+        thread that writes or touches current_command, no lock is needed to
+        keep commands from interleaving on the wire."""
+        while True:
+            item = self._cmd_queue.get()
+            if item is None:
+                break
+            payload, label, wait_time, is_sms_body, fut = item
             try:
-                self.current_command = command
-                logger.debug(f"Sending command: {command}")
-                self.ser.write((command + '\r\n').encode())
-                
-                response = self.wait_for_response(wait_time)
-                
-                logger.debug(f"Raw command response:\n{response}")
-                return response
+                self.current_command = label
+                # Descartar restos de un comando anterior que haya
+                # expirado antes de llegar su respuesta completa
+                self.response_lines.clear()
+                self.response_event.clear()
+                logger.debug("Sending command: %s", label)
+                os.write(self.ser.fileno(), payload)
+                if is_sms_body:
+                    response = self._wait_for_cmgs(wait_time)
+                else:
+                    response = self.wait_for_response(wait_time)
+                logger.debug("Raw command response:\n%s", response)
+                fut.set_result(response)
+            except (serial.SerialException, OSError) as e:
+                logger.error(f"Serial error sending command: {e}")
+                # Cerrar el puerto: así el próximo send_command reconecta en
+                # vez de escribir a un fd muerto
+                if self.ser is not None:
+                    try:
+                        self.ser.close()
+                    except OSError:
+                        pass
+                fut.set_result(f"Error: {str(e)}")
             except Exception as e:
+                # El escritor nunca debe morir con un Future sin resolver
                 logger.error(f"Error sending command: {e}")
-                return f"Error: {str(e)}"
+                fut.set_result(f"Error: {str(e)}")
             finally:
                 self.current_command = None
 
     def wait_for_response(self, timeout):
-        """Wait for a response from the modem for a specified timeout period."""
-        start_time = time.time()
-        response = []
-        while time.time() - start_time < timeout:
-            try:
-                line = self.ser.readline().decode(errors='ignore').strip()
-                if line:
-                    response.append(line)
-                    if line in ['OK', 'ERROR', '>', '+CMS ERROR:'] or '+CMGS:' in line:
-                        break
-            except serial.SerialException as e:
-                logger.error(f"Error reading from serial port: {e}")
-                self.running = False  # Stop running on serial error
+        """Wait for a response from the modem for a specified timeout period.
+
+        Consumes lines produced by read_serial; blocks on the response event
+        until either a line arrives or the deadline passes."""
+        deadline = time.monotonic() + timeout
+        response = self._response_accum
+        response.clear()
+        total_bytes = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 break
+            if not self.response_event.wait(remaining):
+                break
+            self.response_event.clear()
+            while True:
+                try:
+                    line = self.response_lines.popleft()
+                except IndexError:
+                    break
+                response.append(line)
+                total_bytes += len(line)
+                if line in _TERMINAL_CODES or line.startswith(('+CMS ERROR', '+CME ERROR')) or '+CMGS:' in line:
+                    return '\n'.join(response)
+                if total_bytes > self.max_response_bytes:
+                    logger.warning(f"Response exceeded {self.max_response_bytes} bytes; returning truncated response")
+                    return '\n'.join(response)
         return '\n'.join(response)
 
     def read_serial(self):
-        """Continuously read data from the modem and handle it."""
-        buffer = ""
+        """Continuously read data from the modem and handle it.
+
+        Blocks in select() until the kernel reports data, so there is no
+        polling interval and no idle wakeups."""
+        buffer = bytearray()
+        # Buffer de lectura preasignado: readv rellena siempre el mismo bloque
+        # en vez de que cada read asigne un bytes nuevo
+        scratch = bytearray(4096)
+        fd = self.ser.fileno()
         while self.running:
             try:
-                if self.ser and self.ser.in_waiting:
-                    data = self.ser.read(self.ser.in_waiting).decode(errors='ignore')
-                    buffer += data
-                    lines = buffer.split('\n')
-                    buffer = lines.pop()
-                    for line in lines:
-                        line = line.strip()
-                        if line:
-                            logger.debug(f"Raw serial data: {line}")
-                            if self.current_command and (line == self.current_command or line in ['OK', 'ERROR', '>'] or line.startswith('+')):
-                                self.response_queue.put(line)
-                            elif '+CMTI:' in line:
-                                logger.info(f"SMS notification received: {line}")
-                                self.event_queue.put(line)
-                            else:
-                                self.event_queue.put(line)
-            except serial.SerialException as e:
+                if self._poll is not None:
+                    if not self._poll.poll(0.5):
+                        continue
+                else:  # Plataformas sin epoll
+                    ready, _, _ = select.select([fd], [], [], 0.5)
+                    if not ready:
+                        continue
+                n = os.readv(fd, [scratch])
+                if n <= 0:
+                    continue
+                buffer += memoryview(scratch)[:n]
+                while True:
+                    idx = buffer.find(b'\n')
+                    if idx < 0:
+                        break
+                    line = bytes(buffer[:idx]).decode('ascii', 'replace').strip()
+                    del buffer[:idx + 1]
+                    if not line:
+                        continue
+                    # Llamada por línea: saltar el logger entero si DEBUG
+                    # está apagado, no sólo el formateo
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Raw serial data: %s", line)
+                    # Con un comando en vuelo, TODO lo que no sea un URC
+                    # real pertenece a su respuesta: el cuerpo de un CMGR es
+                    # texto arbitrario y no puede clasificarse por forma
+                    if '+CMTI:' in line:
+                        logger.info(f"SMS notification received: {line}")
+                        self._enqueue_event(line)
+                    elif line == 'RING':
+                        self._enqueue_event(line)
+                    elif self.current_command:
+                        self.response_lines.append(line)
+                        self.response_event.set()
+                    else:
+                        self._enqueue_event(line)
+                # El prompt de AT+CMGS ('> ') llega sin newline; no esperar más bytes
+                if self.current_command and buffer.strip() == b'>':
+                    self.response_lines.append('>')
+                    self.response_event.set()
+                    del buffer[:]
+            except (serial.SerialException, OSError) as e:
+                # Única vía de recuperación: cerrar el puerto y dejar que el
+                # próximo send_command dispare la reconexión; cualquier otra
+                # excepción es un bug y debe verse, no dormirse en un bucle
                 logger.error(f"Serial error in read_serial: {e}")
                 self.running = False
+                if self.ser is not None:
+                    try:
+                        self.ser.close()
+                    except OSError:
+                        pass
                 break
-            except Exception as e:
-                logger.error(f"Unexpected error in read_serial: {e}")
-                time.sleep(1)  # Delay to avoid spamming errors
-            time.sleep(0.1)
+
+    def _enqueue_event(self, line):
+        """Queue an event line without ever blocking the read thread."""
+        try:
+            self.event_queue.put_nowait(line)
+        except queue.Full:
+            self._dropped_events += 1
+            logger.warning("Event queue full; %d events dropped so far", self._dropped_events)
 
     def handle_incoming_sms(self, notification):
         """Handle incoming SMS based on notifications from the modem."""
-        match = re.search(r'\+CMTI:\s*"[^"]+",\s*(\d+)', notification)
+        match = _CMTI_RE.search(notification)
         if match:
             index = match.group(1)
             content = self.send_command(f'AT+CMGR={index}')
@@ -179,11 +500,23 @@ class ModemHandler:
             logger.info(f"Parsed SMS content:\n{parsed_content}")
             
             if parsed_content and 'message' in parsed_content:
-                message_id = (parsed_content['sender'], parsed_content['timestamp'], parsed_content['message'])
-                if message_id in self.processed_messages:
+                # Atajo para remitentes de confianza con comandos cortos:
+                # sin digest ni inserción en el mapa de duplicados
+                if (parsed_content['sender'] in self.trusted_senders
+                        and len(parsed_content['message']) < 32):
+                    self.process_sms_command(parsed_content)
+                    delete_response = self.send_command(f'AT+CMGD={index}')
+                    logger.info(f"Delete SMS response: {delete_response}")
+                    return
+                message_id = hashlib.blake2b(
+                    f"{parsed_content['sender']}|{parsed_content['timestamp']}|{parsed_content['message']}".encode('utf-8', 'replace'),
+                    digest_size=16).digest()
+                if message_id in self.processed_digests:
                     logger.info(f"Duplicate message detected. Skipping processing.")
                 else:
-                    self.processed_messages[message_id] = time.time()
+                    if len(self.processed_digests) >= 10000:
+                        self.processed_digests.popitem(last=False)
+                    self.processed_digests[message_id] = time.monotonic()
                     self.process_sms_command(parsed_content)
             
             # Delete the message after reading
@@ -195,27 +528,24 @@ class ModemHandler:
 
     def parse_sms_content(self, content):
         """Parse the content of an SMS received from the modem."""
-        lines = content.split('\n')
-        if len(lines) < 2:
-            logger.error(f"Unexpected SMS format: {content}")
-            return None
-        
-        header = next((line for line in lines if line.startswith('+CMGR:')), '')
-        
-        if not header:
+        # Un solo partition localiza el header sin recorrer línea a línea
+        _, sep, rest = content.partition('+CMGR:')
+        if not sep:
             logger.error(f"CMGR header not found in content: {content}")
             return None
-        
-        # Parse header
-        header_match = re.search(r'\+CMGR:\s*"([^"]+)",\s*"([^"]+)",(.*?),\s*"([^"]+)"', header)
-        if header_match:
-            status, sender, _, timestamp = header_match.groups()
+        header, _, body = rest.partition('\n')
+
+        # Parse header: split posicional en vez de regex con backtracking.
+        # maxsplit=3 deja la coma interna del timestamp dentro del cuarto campo.
+        fields = header.split(',', 3)
+        if len(fields) == 4:
+            status, sender, _, timestamp = (field.strip().strip('"') for field in fields)
         else:
-            logger.error(f"Failed to parse header: {header}")
+            logger.error(f"Failed to parse header: +CMGR:{header}")
             status, sender, timestamp = "Unknown", "Unknown", "Unknown"
-        
+
         # The message content is in the lines after the header
-        message = '\n'.join(line.strip() for line in lines[lines.index(header)+1:] if line.strip() and line.strip() != 'OK')
+        message = '\n'.join(line.strip() for line in body.split('\n') if line.strip() and line.strip() != 'OK')
         
         return {
             "status": status,
@@ -230,17 +560,9 @@ class ModemHandler:
         sender = sms_data['sender']
         logger.info(f"Processing command: {command} from sender: {sender}")
 
-        if command == 'cpu':
-            cpu_usage = self.get_cpu_usage()
-            response = f"CPU Usage: {cpu_usage}%"
-        elif command == 'ram':
-            ram_info = self.get_ram_info()
-            response = f"Available RAM: {ram_info}"
-        elif command == 'signal':
-            signal_strength = self.get_signal_strength()
-            response = f"Signal Strength: {signal_strength}"
-        elif command == 'discover':
-            response = self.execute_mactelnet()
+        handler = self._sms_commands.get(command)
+        if handler is not None:
+            response = handler()
         else:
             response = f"Unknown command: {command}"
             logger.info(f"Unknown command received: {command}")
@@ -259,45 +581,70 @@ class ModemHandler:
             clean_message = clean_message[:max_length-3] + '...'
         return clean_message.strip()
 
+    def _cached_sysinfo(self, key, sample, ttl=1.0):
+        """Return the cached value for `key`, re-sampling at most every `ttl` s."""
+        now = time.monotonic()
+        entry = self._sysinfo_cache.get(key)
+        if entry is not None and now - entry[0] < ttl:
+            return entry[1]
+        value = sample()
+        self._sysinfo_cache[key] = (now, value)
+        return value
+
     def get_cpu_usage(self):
-        """Get the current CPU usage percentage."""
-        return psutil.cpu_percent(interval=1)
+        """Get the CPU usage percentage since the last sample, without blocking."""
+        return self._cached_sysinfo('cpu', lambda: psutil.cpu_percent(interval=None))
 
     def get_ram_info(self):
         """Get the available RAM in MB."""
-        ram = psutil.virtual_memory()
-        return f"{ram.available / (1024 * 1024):.2f} MB"
+        return self._cached_sysinfo(
+            'ram', lambda: f"{psutil.virtual_memory().available / (1024 * 1024):.2f} MB")
 
     def handle_outgoing_sms(self):
         """Handle outgoing SMS messages by sending them from the queue."""
         while self.running:
             try:
-                phone_number, message = self.outgoing_sms_queue.get(timeout=1)
-                self.send_sms(phone_number, message)
+                pending = [self.outgoing_sms_queue.get(timeout=1)]
             except queue.Empty:
                 continue
+            try:
+                # Drenar lo que ya esté encolado y enviarlo en ráfaga
+                while True:
+                    try:
+                        pending.append(self.outgoing_sms_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for phone_number, message in pending:
+                    self.send_sms(phone_number, message)
             except Exception as e:
                 logger.error(f"Error handling outgoing SMS: {e}")
 
     def clean_processed_messages(self):
         """Clean up old processed messages to prevent memory bloat."""
-        current_time = time.time()
-        old_messages = [msg_id for msg_id, timestamp in self.processed_messages.items() if current_time - timestamp > 3600]  # 1 hour
-        for msg_id in old_messages:
-            del self.processed_messages[msg_id]
+        now = time.monotonic()
+        while self.processed_digests:
+            _, timestamp = next(iter(self.processed_digests.items()))
+            if now - timestamp > 3600:  # 1 hour
+                self.processed_digests.popitem(last=False)
+            else:
+                break
 
     def send_sms(self, phone_number, message):
         """Send an SMS message using the modem."""
         logger.info(f"Sending SMS to {phone_number}: {message}")
-        self.send_command('AT+CMGF=1')  # Set text mode
-        self.send_command('AT+CSCS="GSM"')  # Set character set
+        if not self._text_mode_set:
+            # Modo texto + charset encadenados: un round-trip, como en init
+            self.send_command('AT+CMGF=1;+CSCS="GSM"')
+            self._text_mode_set = True
         
         response = self.send_command(f'AT+CMGS="{phone_number}"', wait_time=5)
         
         if '>' in response:
-            full_message = message + chr(26)  # Ctrl+Z to send the message
-            response = self.send_command(full_message, wait_time=10)
-            
+            # El cuerpo + Ctrl-Z se escribe en un solo write y sin el \r\n que
+            # send_command añadiría: CR/LF dentro del cuerpo parte el payload
+            response = self._submit(message.encode('utf-8', 'replace') + b'\x1a',
+                                    '<sms-body>', 10, is_sms_body=True)
+
             if "+CMGS:" in response:
                 logger.info(f"SMS sent successfully to {phone_number}")
                 return True
@@ -308,55 +655,80 @@ class ModemHandler:
             logger.error(f"No prompt received to send SMS. Response: {response}")
             return False
 
+    def _wait_for_cmgs(self, wait_time=10):
+        """Wait for the +CMGS confirmation after the message body, consuming
+        lines up to the final OK/ERROR so nothing stale stays queued."""
+        deadline = time.monotonic() + wait_time
+        response = self._response_accum
+        response.clear()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.response_event.wait(remaining):
+                break
+            self.response_event.clear()
+            while True:
+                try:
+                    line = self.response_lines.popleft()
+                except IndexError:
+                    break
+                response.append(line)
+                if line in ('OK', 'ERROR') or line.startswith(('+CMS ERROR', '+CME ERROR')):
+                    return '\n'.join(response)
+        return '\n'.join(response)
+
     def listen_for_events(self):
         """Listen for events from the modem, such as SMS or incoming calls."""
         while self.running:
             try:
                 event = self.event_queue.get(timeout=0.5)
-                logger.debug(f"Event received: {event}")
-                if '+CMTI:' in event:
-                    logger.info("New SMS notification received!")
-                    self.handle_incoming_sms(event)
-                elif event == 'RING':
-                    logger.info("Incoming call!")
-                    self.handle_incoming_call()
-                elif event in ['OK', 'ERROR']:
-                    logger.debug(f"Modem response: {event}")
+                logger.debug("Event received: %s", event)
+                token = event.split(':', 1)[0].split(' ', 1)[0]
+                handler = self._urc_handlers.get(token)
+                if handler is not None:
+                    handler(event)
+                elif event in _TERMINAL_CODES:
+                    logger.debug("Modem response: %s", event)
                 else:
-                    logger.debug(f"Unhandled event: {event}")
+                    logger.debug("Unhandled event: %s", event)
             except queue.Empty:
                 pass
             except Exception as e:
                 logger.error(f"Error in event listener: {e}")
 
-    def handle_incoming_call(self):
+    def handle_incoming_call(self, event=None):
         """Handle incoming calls if needed."""
         pass
 
     def stop(self):
         """Stop the modem handler and clean up resources."""
         self.running = False
+        self._cmd_queue.put(None)
         if self.ser and self.ser.is_open:
             self.ser.close()
-        if hasattr(self, 'read_thread'):
-            self.read_thread.join()
+        # Despertar a cualquier waiter para que observe running=False
+        self.response_event.set()
+        reader = self.read_thread
+        self.read_thread = None
+        if reader is not None:
+            reader.join(timeout=2)
+            if reader.is_alive():
+                logger.warning("Read thread did not stop within 2s; detaching")
+        # Cerrar epoll sólo con el lector ya parado: close() durante un
+        # poll() en curso levanta ValueError, que el lector no maneja
+        if self._poll is not None:
+            self._poll.close()
+            self._poll = None
 
 
     def interpret_signal_strength(self, csq_response):
         """Interpreta la respuesta del comando AT+CSQ para obtener la intensidad de la señal."""
-        match = re.search(r'\+CSQ:\s*(\d+),', csq_response)
+        match = _CSQ_RE.search(csq_response)
         if match:
-            rssi = int(match.group(1))
-            if rssi == 99:
-                return "No signal"
-            elif rssi >= 20:
-                return f"Excellent (-{73 - (rssi - 20) * 2} dBm)"
-            elif rssi >= 15:
-                return f"Good (-{93 - (rssi - 15) * 2} dBm)"
-            elif rssi >= 10:
-                return f"Fair (-{103 - (rssi - 10) * 2} dBm)"
-            else:
-                return f"Poor (-{113 - rssi * 2} dBm)"
+            label = _CSQ_TABLE.get(int(match.group(1)))
+            if label is not None:
+                return label
         return "Unable to determine signal strength"
 
     def get_signal_strength(self):
@@ -519,6 +891,7 @@ def main():
         modem.stop()
         listen_thread.join()
         outgoing_sms_thread.join()
+        _log_listener.stop()
 
 if __name__ == "__main__":
     main()